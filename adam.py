@@ -37,23 +37,39 @@ class Adam:
         if self.initial_decay > 0:
             lr *= (1. / (1. + self.decay * self.iterations))
 
-        t = self.iterations + 1
-        lr_t = lr * (np.sqrt(1. - np.power(self.beta_2, t)) /
-                     (1. - np.power(self.beta_1, t)))
-
         if not hasattr(self, 'ms'):
             self.ms = [np.zeros_like(p) for p in params]
             self.vs = [np.zeros_like(p) for p in params]
 
-        updated_params = [None] * len(params)
-        for i, p, g, m, v in zip(range(len(params)), params, grads, self.ms, self.vs):
-            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
-            v_t = (self.beta_2 * v) + (1. - self.beta_2) * np.square(g)
-            p_t = p - lr_t * m_t / (np.sqrt(v_t) + self.epsilon)
-            self.ms[i] = m_t
-            self.vs[i] = v_t
-            updated_params[i] = p_t
+        updated_params, self.ms, self.vs = adam_step(params, grads, self.ms, self.vs, self.iterations + 1, lr=lr,
+                                                     beta_1=self.beta_1, beta_2=self.beta_2, epsilon=self.epsilon)
 
         self.iterations += 1
 
         return updated_params
+
+
+def adam_step(params, grads, ms, vs, t, lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-8, backend=np):
+    """
+    Functional Adam step (without decay), used by Adam.update, and e.g. for carrying the optimizer state in a
+    tf.while_loop.
+    :param params: list of arrays/tensors
+    :param grads: list of arrays/tensors; same shapes as params
+    :param ms: list of first moment estimates; same shapes as params
+    :param vs: list of second moment estimates; same shapes as params
+    :param t: step number, starting from 1
+    :param backend: np or tf
+    :return: lists of updated params, ms, and vs
+    """
+    lr_t = lr * (backend.sqrt(1. - beta_2 ** t) / (1. - beta_1 ** t))
+
+    updated_params, updated_ms, updated_vs = [], [], []
+    for p, g, m, v in zip(params, grads, ms, vs):
+        m_t = (beta_1 * m) + (1. - beta_1) * g
+        v_t = (beta_2 * v) + (1. - beta_2) * backend.square(g)
+        p_t = p - lr_t * m_t / (backend.sqrt(v_t) + epsilon)
+        updated_params.append(p_t)
+        updated_ms.append(m_t)
+        updated_vs.append(v_t)
+
+    return updated_params, updated_ms, updated_vs
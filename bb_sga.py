@@ -5,14 +5,17 @@ Yibo Yang, Robert Bamler, Stephan Mandt:
 https://arxiv.org/pdf/2006.04240.pdf
 """
 
+import atexit
+import collections
 import os
 
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')  # silence per-session C++ info logs; must be set before importing tf
+
 import numpy as np
 import tensorflow.compat.v1 as tf
 from absl import app
-from tensorflow_compression.python.ops import math_ops
 
-seed = 0
+seed = 0  # also the global seed of the stateless sampling in compress(), see stateless_seed
 np.random.seed(seed)
 tf.set_random_seed(seed)
 
@@ -23,15 +26,432 @@ from nn_models import MBT2018HyperSynthesisTransform as HyperSynthesisTransform
 SCALES_MIN = 0.11
 SCALES_MAX = 256
 SCALES_LEVELS = 64
+scale_table = np.exp(np.linspace(np.log(SCALES_MIN), np.log(SCALES_MAX), SCALES_LEVELS)).astype('float32')
 
 likelihood_lowerbound = 1e-9
 variance_upperbound = 2e1
+ste_temperature = 5e-2  # SGA temperature below which straight-through rounding replaces Gumbel-softmax sampling
+
+
+def batch_variable(shape, name):
+    """
+    Create a local (non-checkpointed) variable holding a per-batch value, whose batch size may differ between batches.
+    :param shape: static shape of the value, with unknown batch dimension
+    :param name:
+    :return: the variable, and a tensor reading its value with the given static shape
+    """
+    shape = tf.TensorShape(shape)
+    var = tf.Variable(tf.zeros([0] * shape.ndims), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                      validate_shape=False, name=name)
+    value = tf.identity(var)
+    value.set_shape(shape)
+    return var, value
+
+
+def session_config(mixed_precision=False):
+    """
+    The tf.ConfigProto of a compression session, with the Grappler rewrites of configs.grappler_options (and
+    auto_mixed_precision if mixed_precision) and XLA auto-clustering; the rewrites are set on the ConfigProto itself, as
+    a session created with an explicit config ignores those set by tf.config.optimizer.set_experimental_options.
+    """
+    from configs import grappler_options, xla_jit
+    from tensorflow.core.protobuf import rewriter_config_pb2
+    config = tf.ConfigProto()
+    for option, enabled in grappler_options.items():
+        setattr(config.graph_options.rewrite_options, option,
+                rewriter_config_pb2.RewriterConfig.ON if enabled else rewriter_config_pb2.RewriterConfig.OFF)
+    if mixed_precision:
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    if xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_2
+    return config
+
+
+_models = {}  # memoized sessions and model of each (num_filters, checkpoint_dir, runname), see _build_and_restore
+
+
+def _build_and_restore(args):
+    """
+    Build the model (hyperprior and transforms) in a new graph, and restore it from the latest checkpoint in a new
+    session (closed at exit); with configs.mixed_precision, also in a second, mixed precision session for running the
+    optimization loops. Memoized on (num_filters, checkpoint_dir, runname), so that compress() calls on further
+    inputs reuse the session, with the compression graph of each image shape added to the same graph (see
+    compression_graph).
+    :param args:
+    :return: the session, the optimization session (the same session without mixed_precision), and the tuple
+        (hyper_prior, analysis_transform, synthesis_transform, hyper_analysis_transform, hyper_synthesis_transform)
+    """
+    key = (args.num_filters, args.checkpoint_dir, args.runname)
+    if key not in _models:
+        from configs import mixed_precision
+        from learned_prior import BMSHJ2018Prior
+        graph = tf.Graph()
+        with graph.as_default():
+            hyper_prior = BMSHJ2018Prior(args.num_filters, dims=(3, 3, 3))
+
+            # Instantiate model.
+            analysis_transform = AnalysisTransform(args.num_filters)
+            synthesis_transform = SynthesisTransform(args.num_filters)
+            hyper_analysis_transform = HyperAnalysisTransform(args.num_filters,
+                                                              num_output_filters=2 * args.num_filters)
+            hyper_synthesis_transform = HyperSynthesisTransform(args.num_filters,
+                                                                num_output_filters=2 * args.num_filters)
+            # entropy_bottleneck = tfc.EntropyBottleneck()
+
+            # the Keras layers only create their variables when first called
+            y = analysis_transform(tf.placeholder('float32', (None, None, None, 3)))
+            z = hyper_analysis_transform(y)[..., :args.num_filters]
+            hyper_synthesis_transform(z)
+            synthesis_transform(y)
+
+            saver = tf.train.Saver()  # only the model variables; all the optimization state lives in local variables
+
+        sess = tf.Session(graph=graph, config=session_config())
+        opt_sess = tf.Session(graph=graph, config=session_config(mixed_precision=True)) if mixed_precision else sess
+        # Load the latest model checkpoint
+        save_dir = os.path.join(args.checkpoint_dir, args.runname)
+        latest = tf.train.latest_checkpoint(checkpoint_dir=save_dir)
+        for session in {sess, opt_sess}:
+            atexit.register(session.close)
+            saver.restore(session, save_path=latest)
+        _models[key] = sess, opt_sess, (hyper_prior, analysis_transform, synthesis_transform,
+                                        hyper_analysis_transform, hyper_synthesis_transform)
+    return _models[key]
+
+
+CompressionGraph = collections.namedtuple('CompressionGraph', [
+    'images_ph', 'num_images_ph', 'load_images', 'init_batches', 'load_x', 'batch_seed', 'rd_init_op', 'rd_opt_op',
+    'rd_hists', 'rd_opt_its', 'r_init_op', 'r_opt_op', 'r_hist', 'r_opt_its', 'log_itv', 'eval_tensors', 'latents',
+    'latent_phs', 'load_latents', 'release_op'])
+_compression_graphs = {}  # memoized CompressionGraph of each model, image shape and optimization settings
+
+
+def compression_graph(args, image_shape):
+    """
+    Get the compression graph for images of shape image_shape (= [H, W, 3]); memoized on the model, image shape, and
+    the args the graph depends on, so that compress() calls on further inputs of the same shape reuse the graph and
+    its (per-input) variables.
+    """
+    key = (args.num_filters, args.checkpoint_dir, args.runname, tuple(image_shape), args.lmbda, args.verbose,
+           args.annealing_rate, args.t0)
+    if key not in _compression_graphs:
+        _compression_graphs[key] = _build_compression_graph(args, image_shape)
+    return _compression_graphs[key]
+
+
+def _build_compression_graph(args, image_shape):
+    """
+    Build the graph that loads the input into the device, and performs the optimization and evaluation of each batch
+    of it, in the graph of the (memoized) model.
+    :param args:
+    :param image_shape: [H, W, 3]
+    :return: a CompressionGraph
+    """
+    from configs import get_eval_batch_size
+    img_num_pixels = int(np.prod(image_shape[:-1]))
+    eval_batch_size = get_eval_batch_size(img_num_pixels)
+
+    sess, _, (hyper_prior, analysis_transform, synthesis_transform, hyper_analysis_transform,
+              hyper_synthesis_transform) = _build_and_restore(args)
+    # the graph for this image shape is added to the graph of the (memoized) model
+    with sess.graph.as_default():
+        # The whole dataset is kept resident on the device, in a (non-checkpointed) local variable loaded once from
+        # the input at the start of each compress() call, and emptied at its end; the dataset only yields the indices
+        # of each batch.
+        images_ph = tf.placeholder('float32', (None, *image_shape))
+        images_var, images = batch_variable((None, *image_shape), name='images')
+        num_images_ph = tf.placeholder('int64', shape=[], name='num_images')
+        load_images = tf.assign(images_var, images_ph, validate_shape=False)
+        dataset = tf.data.Dataset.range(num_images_ph)
+        dataset = dataset.batch(batch_size=eval_batch_size)
+        # https://www.tensorflow.org/api_docs/python/tf/compat/v1/data/Iterator
+        # Importantly, each sess.run(op) call will consume a new batch, where op is any operation that depends on
+        # x. Therefore if multiple ops need to be evaluated on the same batch of data, they have to be grouped like
+        # sess.run([op1, op2, ...]).
+        iterator = dataset.make_initializable_iterator()
+        batch_indices = iterator.get_next()
+
+        # The current batch is gathered once into another local variable, so that it never has to be fed during the many
+        # optimization steps performed on the same batch.
+        x_var, x = batch_variable((None, *image_shape), name='x')  # the last batch may be smaller
+        load_x = tf.assign(x_var, tf.gather(images, batch_indices), validate_shape=False)
+
+        #### BEGIN build compression graph ####
+        from utils import log_normal_pdf, annealed_temperature
+        from adam import adam_step
+
+        y_init = analysis_transform(x)
+        # y, z_mean and z_logvar live on the device as variables, and are only fetched back when a batch is done
+        y_var, y = batch_variable(y_init.shape, name='y')
+        # z_tilde ~ q(z_tilde | h_a(\tilde y))
+        # initialize to inference network results, based on y_init for R-D optimization, or on round(y) for rate
+        # optimization
+        z_mean_init, z_logvar_init = tf.split(hyper_analysis_transform(y_init), num_or_size_splits=2, axis=-1)
+        y_hat = tf.round(y)  # the latents we end up transmitting
+        z_mean_r_init, z_logvar_r_init = tf.split(hyper_analysis_transform(y_hat), num_or_size_splits=2, axis=-1)
+        z_mean_var, z_mean = batch_variable(z_mean_init.shape, name='z_mean')
+        z_logvar_var, z_logvar = batch_variable(z_logvar_init.shape, name='z_logvar')
+
+        # Initial optimization (where we still have access to x)
+        # Soft-to-hard rounding with Gumbel-softmax trick; for each element of z_tilde, let R be a 2D auxiliary one-hot
+        # random vector, such that R=[1, 0] means rounding DOWN and [0, 1] means rounding UP.
+        # Let the logits of each outcome be -(z - z_floor) / T and -(z_ceil - z) / T (i.e., Boltzmann distribution with
+        # energies (z - floor(z)) and (ceil(z) - z), so p(R==[1,0]) = softmax((z - z_floor) / T), ...
+        # Let z_tilde = p(R==[1,0]) * floor(z) + p(R==[0,1]) * ceil(z), so z_tilde -> round(z) as T -> 0.
+        epsilon = 1e-5
+
+        # All the sampling is done with stateless random ops, seeded by the global seed (which the graph-level
+        # tf.set_random_seed has no effect on), the batch, and the (stream, iteration) indices of each sample, so it is
+        # reproducible without any RNG state shared between iterations; the streams are
+        # 0: relaxed rounding in the R-D optimization, 1: rate in the R-D optimization,
+        # 2: rate in the rate optimization, 3: rate of the rounded latents y_hat outside of the optimization,
+        # 4: rate of the rounded latents in the (verbose) logging metrics of the R-D optimization.
+        batch_seed = tf.placeholder('int32', shape=[], name='batch_seed')
+
+        def stateless_seed(stream, it):
+            return tf.stack([seed * 2 ** 32 + tf.cast(batch_seed, 'int64'), stream * 2 ** 32 + tf.cast(it, 'int64')])
+
+        def relaxed_round(y, T, seed):
+            """
+            Sample the soft-to-hard rounding y_tilde of y at temperature T; below ste_temperature, the samples are
+            essentially one-hot, and y is simply rounded with a straight-through estimate of the gradient instead.
+            """
+            y_floor = tf.floor(y)
+            y_ceil = tf.ceil(y)
+            y_bds = tf.stack([y_floor, y_ceil], axis=-1)
+            # The logits for DOWN or UP are -atanh(frac) / T and -atanh(ceil - y) / T, with frac = y - floor(y) and
+            # ceil - y = 1 - frac (if y is an integer, floor = ceil and the logits do not matter). The rounding
+            # distribution only depends on their difference, so we use the equivalent centered logits
+            # +/- (atanh(1 - frac) - atanh(frac)) / 2T, using atanh(x) = 0.5 * log((1 + x) / (1 - x)) to compute them
+            # with a single log.
+            frac = tf.clip_by_value(y - y_floor, epsilon, 1 - epsilon)  # clip to prevent NaN as temperature -> 0
+            half_logit_diff = 0.25 * tf.log((2 - frac) * (1 - frac) / (frac * (1 + frac))) / T
+            logits = tf.stack([half_logit_diff, -half_logit_diff], axis=-1)  # last dim are logits for DOWN or UP
+
+            def sample_round():
+                # sample from RelaxedOneHotCategorical(T, logits=logits) with the Gumbel-softmax reparameterization
+                uniform = tf.random.stateless_uniform(tf.shape(logits), seed=seed, minval=np.finfo(np.float32).tiny)
+                gumbel = -tf.log(-tf.log(uniform))
+                # technically we can use a different temperature here
+                sample_concrete = tf.nn.softmax((logits + gumbel) / T, axis=-1)
+                return tf.reduce_sum(y_bds * sample_concrete, axis=-1)  # inner product in last dim
+
+            def ste_round():
+                # forward pass is round(y); backward pass uses the gradient of the expected rounding under
+                # softmax(logits)
+                soft_round = tf.reduce_sum(y_bds * tf.nn.softmax(logits, axis=-1), axis=-1)
+                return tf.round(y) + soft_round - tf.stop_gradient(soft_round)
+
+            return tf.cond(T < ste_temperature, ste_round, sample_round)
+
+        # the graph is built for the image shape of X, so the crops to the image/latent sizes below use static sizes
+        # (rather than tf.shape), which Grappler can fold
+        img_height, img_width = image_shape[:2]
+        y_height, y_width = y_init.shape.as_list()[1:3]
+        axes_except_batch = list(range(1, len(x.shape)))  # should be [1,2,3]
+        # converts a (summed) log-likelihood in nats into bits per pixel, as a single float32 multiplication
+        neg_inv_log2_num_pixels = tf.constant(-1. / (np.log(2) * img_num_pixels), dtype='float32')
+
+        def bits_per_pixel(y_tilde, z_mean, z_logvar, seed):
+            """
+            Build the (bits-back) rate of y_tilde, estimated with a single sample
+            z_tilde ~ q(z_tilde | z_mean, z_logvar).
+            :param y_tilde: (relaxed or rounded) latents
+            :param z_mean:
+            :param z_logvar:
+            :param seed: seed of the sample z_tilde
+            :return: per-image total bpp, y bpp, z bpp and bits-back bpp; each of shape (N,)
+            """
+            eps = tf.random.stateless_normal(shape=tf.shape(z_mean), seed=seed)
+            z_tilde = eps * tf.exp(z_logvar * .5) + z_mean
+
+            log_q_z_tilde = log_normal_pdf(z_tilde, z_mean, z_logvar)  # bits back
+
+            # compute the pdf of z_tilde under the flexible (hyper)prior p(z_tilde) ("z_likelihoods")
+            z_likelihoods = hyper_prior.pdf(z_tilde, stop_gradient=False)
+            # plain tf.maximum rather than math_ops.lower_bound (whose custom gradient XLA can't fuse through); the
+            # bound is essentially never active on the likelihoods we optimize
+            z_likelihoods = tf.maximum(z_likelihoods, likelihood_lowerbound)
+
+            # compute parameters of p(y_tilde|z_tilde)
+            # need to handle images with non-standard sizes during compression; mu/sigma must have the same shape as y,
+            # so the crop is done by the same slice that splits the channels
+            hyper_syn_out = hyper_synthesis_transform(z_tilde)
+            mu = hyper_syn_out[:, :y_height, :y_width, :args.num_filters]
+            sigma = tf.exp(hyper_syn_out[:, :y_height, :y_width, args.num_filters:])  # make positive
+            conditional_bottleneck = tfc.GaussianConditional(sigma, scale_table, mean=mu)
+            # compute the pdf of y_tilde under the conditional prior/entropy model p(y_tilde|z_tilde)
+            # = N(y_tilde|mu, sigma^2) conv U(-0.5, 0.5)
+            y_likelihoods = conditional_bottleneck._likelihood(y_tilde)  # p(\tilde y | \tilde z)
+            if conditional_bottleneck.likelihood_bound > 0:
+                likelihood_bound = conditional_bottleneck.likelihood_bound
+                y_likelihoods = tf.maximum(y_likelihoods, likelihood_bound)
+
+            # Total number of bits divided by number of pixels.
+            # - log p(\tilde y | \tilde z) - log p(\tilde z) - - log q(\tilde z | \tilde y)
+            batch_log_cond_p_y_tilde = tf.reduce_sum(tf.log(y_likelihoods), axis=axes_except_batch)
+            y_bpp = batch_log_cond_p_y_tilde * neg_inv_log2_num_pixels
+            # the net rate of z_tilde is reduced in a single pass over the (elementwise) log p(\tilde z) - log q(\tilde
+            # z); the separate z and bits-back rates below are only computed when fetched for evaluation
+            batch_log_p_over_q_z_tilde = tf.reduce_sum(tf.log(z_likelihoods) - log_q_z_tilde, axis=axes_except_batch)
+            eval_bpp = y_bpp + batch_log_p_over_q_z_tilde * neg_inv_log2_num_pixels  # shape (N,)
+            batch_log_q_z_tilde = tf.reduce_sum(log_q_z_tilde, axis=axes_except_batch)
+            bpp_back = batch_log_q_z_tilde * neg_inv_log2_num_pixels
+            batch_log_p_z_tilde = tf.reduce_sum(tf.log(z_likelihoods), axis=axes_except_batch)
+            z_bpp = batch_log_p_z_tilde * neg_inv_log2_num_pixels
+            return eval_bpp, y_bpp, z_bpp, bpp_back
+
+        # The rate-distortion cost (with args.lmbda defaulted in compress()).
+        def rd_terms(y_tilde, z_mean, z_logvar, seed):
+            """
+            Build the rate-distortion cost of y_tilde, with the rate estimated by bits_per_pixel.
+            :param y_tilde: (relaxed or rounded) latents
+            :param z_mean:
+            :param z_logvar:
+            :param seed: seed of the rate estimate
+            :return: rd_loss, train_mse, train_bpp, the reconstruction x_tilde, and the per-image bpps from
+                bits_per_pixel
+            """
+            x_tilde = synthesis_transform(y_tilde)
+            x_tilde = x_tilde[:, :img_height, :img_width, :]  # crop reconstruction to have the same shape as input
+            bpps = bits_per_pixel(y_tilde, z_mean, z_logvar, seed)
+            train_bpp = tf.reduce_mean(bpps[0])
+
+            # Mean squared error across pixels.
+            train_mse = tf.reduce_mean(tf.squared_difference(x, x_tilde))
+            # Multiply by 255^2 to correct for rescaling.
+            # float_train_mse = train_mse
+            # psnr = - 10 * (tf.log(float_train_mse) / np.log(10))  # float MSE computed on float images
+            train_mse *= 255 ** 2
+
+            if args.lmbda > 0:
+                rd_loss = args.lmbda * train_mse + train_bpp
+            else:
+                rd_loss = train_bpp
+            return rd_loss, train_mse, train_bpp, x_tilde, bpps
+
+        # Bring both images back to 0..255 range, for evaluation only.
+        x_eval = x * 255
+
+        def quantize_reconstruction(x_tilde):
+            x_tilde = tf.clip_by_value(x_tilde, 0, 1)
+            return tf.round(x_tilde * 255)
+
+        # Cost of the rounded latents y_hat; built before the optimization loop below, which re-uses the transforms.
+        # Rate optimization only involves y_hat, which does not change during it; the rate (without the synthesis
+        # transform, and with y_hat computed on the device) is all that each rate step needs to run.
+        rd_loss_hat, train_mse_hat, train_bpp_hat, x_hat, (eval_bpp, y_bpp, z_bpp, bpp_back) = rd_terms(
+            y_hat, z_mean, z_logvar, stateless_seed(3, 0))
+        x_hat = quantize_reconstruction(x_hat)
+        #### END build compression graph ####
+
+        # R-D optimization of y, z_mean and z_logvar, with all the iterations run by a single tf.while_loop (the Adam
+        # moments only need to live in the loop).
+        rd_lr = 0.005
+        # rd_opt_its = args.sga_its
+        rd_opt_its = 10
+        annealing_scheme = 'exp0'
+        annealing_rate = args.annealing_rate  # default annealing_rate = 1e-3
+        t0 = args.t0  # default t0 = 700
+        T_ub = 0.5  # max/initial temperature
+        log_itv = 100
+
+        rd_vars = [y_var, z_mean_var, z_logvar_var]
+        rd_params = [y, z_mean, z_logvar]
+        rd_init_op = tf.group(tf.assign(y_var, y_init, validate_shape=False),
+                              tf.assign(z_mean_var, z_mean_init, validate_shape=False),
+                              tf.assign(z_logvar_var, z_logvar_init, validate_shape=False))
+        # psnr, and in verbose mode also rd_loss, bpp and psnr after rounding the updated latents
+        num_log_metrics = 4 if args.verbose else 1
+
+        def rd_step(it, params, ms, vs, hists):
+            temperature = annealed_temperature(tf.cast(it, 'float32'), r=annealing_rate, ub=T_ub, backend=tf,
+                                               scheme=annealing_scheme, t0=t0)
+            y, z_mean, z_logvar = params
+            rd_loss, train_mse, train_bpp, x_tilde, _ = rd_terms(relaxed_round(y, temperature, stateless_seed(0, it)),
+                                                                   z_mean, z_logvar, stateless_seed(1, it))
+            grads = tf.gradients(rd_loss, params)
+            params, ms, vs = adam_step(params, grads, ms, vs, tf.cast(it + 1, 'float32'), lr=rd_lr, backend=tf)
+
+            def compute_log_metrics():
+                log_metrics = [tf.reduce_mean(tf.image.psnr(quantize_reconstruction(x_tilde), x_eval, 255))]
+                if args.verbose:
+                    y, z_mean, z_logvar = params
+                    rd_loss_hat, _, train_bpp_hat, x_hat, _ = rd_terms(tf.round(y), z_mean, z_logvar,
+                                                                       stateless_seed(4, it))
+                    log_metrics += [rd_loss_hat, train_bpp_hat,
+                                    tf.reduce_mean(tf.image.psnr(quantize_reconstruction(x_hat), x_eval, 255))]
+                return log_metrics
+
+            # the logging metrics (in particular, the reconstruction of the rounded latents) are only computed on
+            # logging iterations, in the same run as the optimization
+            is_log_it = tf.logical_or(tf.equal(it % log_itv, 0), tf.equal(it + 1, rd_opt_its))
+            log_metrics = tf.cond(is_log_it, compute_log_metrics, lambda: [tf.constant(0.)] * num_log_metrics,
+                                  strict=True)
+            hists = [hist.write(it, val) for hist, val in
+                     zip(hists, [temperature, rd_loss, train_mse, train_bpp] + log_metrics)]
+            return [it + 1, params, ms, vs, hists]
+
+        _, rd_params_out, _, _, rd_hists = tf.while_loop(
+            lambda it, *_: it < rd_opt_its, rd_step,
+            [tf.constant(0), rd_params, [tf.zeros_like(param) for param in rd_params],
+             [tf.zeros_like(param) for param in rd_params],
+             [tf.TensorArray('float32', size=rd_opt_its) for _ in range(4 + num_log_metrics)]], back_prop=False)
+        rd_opt_op = tf.group(*[tf.assign(var, val, validate_shape=False) for var, val in zip(rd_vars, rd_params_out)])
+        rd_hists = [hist.stack() for hist in rd_hists]  # T, rd_loss, mse, bpp and the logging metrics of each iteration
+
+        # Rate optimization of z_mean and z_logvar given y_hat, with all the iterations run by a single tf.while_loop
+        # (the Adam moments only need to live in the loop).
+        r_lr = 0.003
+        r_opt_its = 100
+
+        r_vars = [z_mean_var, z_logvar_var]
+        r_params = [z_mean, z_logvar]
+        r_init_op = tf.group(tf.assign(z_mean_var, z_mean_r_init, validate_shape=False),
+                             tf.assign(z_logvar_var, z_logvar_r_init, validate_shape=False))
+
+        def r_step(it, params, ms, vs, hist):
+            z_mean, z_logvar = params
+            train_bpp = tf.reduce_mean(bits_per_pixel(y_hat, z_mean, z_logvar, stateless_seed(2, it))[0])
+            grads = tf.gradients(train_bpp, params)
+            params, ms, vs = adam_step(params, grads, ms, vs, tf.cast(it + 1, 'float32'), lr=r_lr, backend=tf)
+            return [it + 1, params, ms, vs, hist.write(it, train_bpp)]
+
+        _, r_params_out, _, _, r_hist = tf.while_loop(
+            lambda it, *_: it < r_opt_its, r_step,
+            [tf.constant(0), r_params, [tf.zeros_like(param) for param in r_params],
+             [tf.zeros_like(param) for param in r_params], tf.TensorArray('float32', size=r_opt_its)], back_prop=False)
+        r_opt_op = tf.group(*[tf.assign(var, val, validate_shape=False) for var, val in zip(r_vars, r_params_out)])
+        r_hist = r_hist.stack()  # rate of each iteration
+
+        # The evaluation metrics are only run by the evaluation fetch of each batch (sess.run prunes the graph to the
+        # fetches, so the optimization runs neither execute nor optimize the MS-SSIM pyramid); the psnr re-uses mse,
+        # as in tf.image.psnr(x_hat, x_eval, 255).
+        mse = tf.reduce_mean(tf.squared_difference(x_eval, x_hat), axis=axes_except_batch)  # shape (N,)
+        psnr = (tf.constant(20 * np.log10(255), dtype='float32') -
+                tf.constant(10 / np.log(10), dtype='float32') * tf.log(mse))  # shape (N,)
+        msssim = tf.image.ssim_multiscale(x_hat, x_eval, 255)  # shape (N,)
+        msssim_db = tf.constant(-10 / np.log(10), dtype='float32') * tf.math.log1p(-msssim)  # shape (N,)
+
+        # frees the device memory of the input and of the last batch, once the compress() call is done with them
+        release_op = tf.group(*[tf.assign(var, tf.zeros([0] * value.shape.ndims), validate_shape=False)
+                                for var, value in [(images_var, images), (x_var, x), (y_var, y), (z_mean_var, z_mean),
+                                                   (z_logvar_var, z_logvar)]])
+        eval_tensors = [mse, psnr, msssim, msssim_db, eval_bpp, y_bpp, z_bpp, bpp_back]
+
+        # for copying the latents between the sessions, if the optimization runs in a mixed precision one
+        latents = [y, z_mean, z_logvar]
+        latent_phs = [tf.placeholder('float32', latent.shape) for latent in latents]
+        load_latents = tf.group(*[tf.assign(var, latent_ph, validate_shape=False) for var, latent_ph in
+                                  zip([y_var, z_mean_var, z_logvar_var], latent_phs)])
+
+    return CompressionGraph(images_ph, num_images_ph, load_images, iterator.initializer, load_x, batch_seed,
+                            rd_init_op, rd_opt_op, rd_hists, rd_opt_its, r_init_op, r_opt_op, r_hist, r_opt_its,
+                            log_itv, eval_tensors, latents, latent_phs, load_latents, release_op)
 
 
 def compress(args):
     """Compresses an image, or a batch of images of the same shape in npy format."""
-    from configs import get_eval_batch_size
-
     if args.input_file.endswith('.npy'):
         # .npy file should contain N images of the same shapes, in the form of an array of shape [N, H, W, 3]
         X = np.load(args.input_file)
@@ -42,260 +462,114 @@ def compress(args):
         X = x[None, ...]
 
     num_images = int(X.shape[0])
-    img_num_pixels = int(np.prod(X.shape[1:-1]))
     X = X.astype('float32')
     X /= 255.
 
-    eval_batch_size = get_eval_batch_size(img_num_pixels)
-    dataset = tf.data.Dataset.from_tensor_slices(X)
-    dataset = dataset.batch(batch_size=eval_batch_size)
-    # https://www.tensorflow.org/api_docs/python/tf/compat/v1/data/Iterator
-    # Importantly, each sess.run(op) call will consume a new batch, where op is any operation that depends on
-    # x. Therefore if multiple ops need to be evaluated on the same batch of data, they have to be grouped like
-    # sess.run([op1, op2, ...]).
-    # x = dataset.make_one_shot_iterator().get_next()
-    x_next = dataset.make_one_shot_iterator().get_next()
-
-    x_ph = x = tf.placeholder('float32', (None, *X.shape[1:]))  # keep a reference around for feed_dict
-
-    #### BEGIN build compression graph ####
-    from utils import log_normal_pdf
-    from learned_prior import BMSHJ2018Prior
-    hyper_prior = BMSHJ2018Prior(args.num_filters, dims=(3, 3, 3))
-
-    # Instantiate model.
-    analysis_transform = AnalysisTransform(args.num_filters)
-    synthesis_transform = SynthesisTransform(args.num_filters)
-    hyper_analysis_transform = HyperAnalysisTransform(args.num_filters, num_output_filters=2 * args.num_filters)
-    hyper_synthesis_transform = HyperSynthesisTransform(args.num_filters, num_output_filters=2 * args.num_filters)
-    # entropy_bottleneck = tfc.EntropyBottleneck()
-
-    # Initial optimization (where we still have access to x)
-    # Soft-to-hard rounding with Gumbel-softmax trick; for each element of z_tilde, let R be a 2D auxiliary one-hot
-    # random vector, such that R=[1, 0] means rounding DOWN and [0, 1] means rounding UP.
-    # Let the logits of each outcome be -(z - z_floor) / T and -(z_ceil - z) / T (i.e., Boltzmann distribution with
-    # energies (z - floor(z)) and (ceil(z) - z), so p(R==[1,0]) = softmax((z - z_floor) / T), ...
-    # Let z_tilde = p(R==[1,0]) * floor(z) + p(R==[0,1]) * ceil(z), so z_tilde -> round(z) as T -> 0.
-    import tensorflow_probability as tfp
-    T = tf.placeholder('float32', shape=[], name='temperature')
-    y_init = analysis_transform(x)
-    y = tf.placeholder('float32', y_init.shape)
-    y_floor = tf.floor(y)
-    y_ceil = tf.ceil(y)
-    y_bds = tf.stack([y_floor, y_ceil], axis=-1)
-    epsilon = 1e-5
-    logits = tf.stack([-tf.math.atanh(tf.clip_by_value(y - y_floor, -1 + epsilon, 1 - epsilon)) / T,
-                       -tf.math.atanh(tf.clip_by_value(y_ceil - y, -1 + epsilon, 1 - epsilon)) / T],
-                      axis=-1)  # last dim are logits for DOWN or UP; clip to prevent NaN as temperature -> 0
-    rounding_dist = tfp.distributions.RelaxedOneHotCategorical(T,
-                                                               logits=logits)  # technically we can use a different temperature here
-    sample_concrete = rounding_dist.sample()
-    y_tilde = tf.reduce_sum(y_bds * sample_concrete, axis=-1)  # inner product in last dim
-    x_tilde = synthesis_transform(y_tilde)
-    x_shape = tf.shape(x)
-    x_tilde = x_tilde[:, :x_shape[1], :x_shape[2], :]  # crop reconstruction to have the same shape as input
-
-    # z_tilde ~ q(z_tilde | h_a(\tilde y))
-    z_mean_init, z_logvar_init = tf.split(hyper_analysis_transform(y_tilde), num_or_size_splits=2, axis=-1)
-    z_mean = tf.placeholder('float32', z_mean_init.shape)  # initialize to inference network results
-    z_logvar = tf.placeholder('float32', z_logvar_init.shape)
-
-    eps = tf.random.normal(shape=tf.shape(z_mean))
-    z_tilde = eps * tf.exp(z_logvar * .5) + z_mean
-
-    log_q_z_tilde = log_normal_pdf(z_tilde, z_mean, z_logvar)  # bits back
-
-    # compute the pdf of z_tilde under the flexible (hyper)prior p(z_tilde) ("z_likelihoods")
-    z_likelihoods = hyper_prior.pdf(z_tilde, stop_gradient=False)
-    z_likelihoods = math_ops.lower_bound(z_likelihoods, likelihood_lowerbound)
-
-    # compute parameters of p(y_tilde|z_tilde)
-    mu, sigma = tf.split(hyper_synthesis_transform(z_tilde), num_or_size_splits=2, axis=-1)
-    sigma = tf.exp(sigma)  # make positive
-
-    # need to handle images with non-standard sizes during compression; mu/sigma must have the same shape as y
-    y_shape = tf.shape(y_tilde)
-    mu = mu[:, :y_shape[1], :y_shape[2], :]
-    sigma = sigma[:, :y_shape[1], :y_shape[2], :]
-    scale_table = np.exp(np.linspace(np.log(SCALES_MIN), np.log(SCALES_MAX), SCALES_LEVELS))
-    conditional_bottleneck = tfc.GaussianConditional(sigma, scale_table, mean=mu)
-    # compute the pdf of y_tilde under the conditional prior/entropy model p(y_tilde|z_tilde)
-    # = N(y_tilde|mu, sigma^2) conv U(-0.5, 0.5)
-    y_likelihoods = conditional_bottleneck._likelihood(y_tilde)  # p(\tilde y | \tilde z)
-    if conditional_bottleneck.likelihood_bound > 0:
-        likelihood_bound = conditional_bottleneck.likelihood_bound
-        y_likelihoods = math_ops.lower_bound(y_likelihoods, likelihood_bound)
-    #### END build compression graph ####
-
-    # Total number of bits divided by number of pixels.
-    # - log p(\tilde y | \tilde z) - log p(\tilde z) - - log q(\tilde z | \tilde y)
-    axes_except_batch = list(range(1, len(x.shape)))  # should be [1,2,3]
-    batch_log_q_z_tilde = tf.reduce_sum(log_q_z_tilde, axis=axes_except_batch)
-    bpp_back = -batch_log_q_z_tilde / (np.log(2) * img_num_pixels)
-    batch_log_cond_p_y_tilde = tf.reduce_sum(tf.log(y_likelihoods), axis=axes_except_batch)
-    y_bpp = -batch_log_cond_p_y_tilde / (np.log(2) * img_num_pixels)
-    batch_log_p_z_tilde = tf.reduce_sum(tf.log(z_likelihoods), axis=axes_except_batch)
-    z_bpp = -batch_log_p_z_tilde / (np.log(2) * img_num_pixels)
-    eval_bpp = y_bpp + z_bpp - bpp_back  # shape (N,)
-    train_bpp = tf.reduce_mean(eval_bpp)
-
-    # Mean squared error across pixels.
-    train_mse = tf.reduce_mean(tf.squared_difference(x, x_tilde))
-    # Multiply by 255^2 to correct for rescaling.
-    # float_train_mse = train_mse
-    # psnr = - 10 * (tf.log(float_train_mse) / np.log(10))  # float MSE computed on float images
-    train_mse *= 255 ** 2
-
-    # The rate-distortion cost.
+    # The rate-distortion cost; lmbda is resolved before getting the (memoized) graph, which depends on it.
     if args.lmbda < 0:
         args.lmbda = float(args.runname.split('lmbda=')[1].split('-')[0])  # re-use the lmbda as used for training
         print('Defaulting lmbda (mse coefficient) to %g as used in model training.' % args.lmbda)
-    if args.lmbda > 0:
-        rd_loss = args.lmbda * train_mse + train_bpp
-    else:
-        rd_loss = train_bpp
-    rd_gradients = tf.gradients(rd_loss, [y, z_mean, z_logvar])
-    r_gradients = tf.gradients(train_bpp, [z_mean, z_logvar])
-
-    # Bring both images back to 0..255 range, for evaluation only.
-    x *= 255
-    x_tilde = tf.clip_by_value(x_tilde, 0, 1)
-    x_tilde = tf.round(x_tilde * 255)
-
-    mse = tf.reduce_mean(tf.squared_difference(x, x_tilde), axis=axes_except_batch)  # shape (N,)
-    psnr = tf.image.psnr(x_tilde, x, 255)  # shape (N,)
-    msssim = tf.image.ssim_multiscale(x_tilde, x, 255)  # shape (N,)
-    msssim_db = -10 * tf.log(1 - msssim) / np.log(10)  # shape (N,)
-
-    with tf.Session() as sess:
-        # Load the latest model checkpoint, get compression stats
-        save_dir = os.path.join(args.checkpoint_dir, args.runname)
-        latest = tf.train.latest_checkpoint(checkpoint_dir=save_dir)
-        tf.train.Saver().restore(sess, save_path=latest)
-        eval_fields = ['mse', 'psnr', 'msssim', 'msssim_db', 'est_bpp', 'est_y_bpp', 'est_z_bpp', 'est_bpp_back']
-        eval_tensors = [mse, psnr, msssim, msssim_db, eval_bpp, y_bpp, z_bpp, bpp_back]
-        all_results_arrs = {key: [] for key in eval_fields}  # append across all batches
 
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-
-        log_itv = 100
-        rd_lr = 0.005
-        # rd_opt_its = args.sga_its
-        rd_opt_its = 10
-        annealing_scheme = 'exp0'
-        annealing_rate = args.annealing_rate  # default annealing_rate = 1e-3
-        t0 = args.t0  # default t0 = 700
-        T_ub = 0.5  # max/initial temperature
-        from utils import annealed_temperature
-        r_lr = 0.003
-        r_opt_its = 100
-        from adam import Adam
-
-        batch_idx = 0
-        while True:
-            try:
-                x_val = sess.run(x_next)
-                x_feed_dict = {x_ph: x_val}
-                # 1. Perform R-D optimization conditioned on ground truth x
-                print('----RD Optimization----')
-                y_cur = sess.run(y_init, feed_dict=x_feed_dict)  # np arrays
-                z_mean_cur, z_logvar_cur = sess.run([z_mean_init, z_logvar_init], feed_dict={y_tilde: y_cur})
-                rd_loss_hist = []
-                adam_optimizer = Adam(lr=rd_lr)
-
-                opt_record = {'its': [], 'T': [], 'rd_loss': [], 'rd_loss_after_rounding': []}
-                for it in range(rd_opt_its):
-                    temperature = annealed_temperature(it, r=annealing_rate, ub=T_ub, scheme=annealing_scheme, t0=t0)
-                    grads, obj, mse_, train_bpp_, psnr_ = sess.run([rd_gradients, rd_loss, train_mse, train_bpp, psnr],
-                                                                   feed_dict={y: y_cur, z_mean: z_mean_cur,
-                                                                              z_logvar: z_logvar_cur,
-                                                                              **x_feed_dict, T: temperature})
-                    y_cur, z_mean_cur, z_logvar_cur = adam_optimizer.update([y_cur, z_mean_cur, z_logvar_cur], grads)
-                    if it % log_itv == 0 or it + 1 == rd_opt_its:
-                        psnr_ = psnr_.mean()
-                        if args.verbose:
-                            bpp_after_rounding, psnr_after_rounding, rd_loss_after_rounding = sess.run(
-                                [train_bpp, psnr, rd_loss],
-                                feed_dict={
-                                    y_tilde: np.round(y_cur),
-                                    z_mean: z_mean_cur,
-                                    z_logvar: z_logvar_cur,
-                                    **x_feed_dict})
-                            psnr_after_rounding = psnr_after_rounding.mean()
-                            print(
-                                'it=%d, T=%.3f rd_loss=%.4f mse=%.3f bpp=%.4f psnr=%.4f\t after rounding: rd_loss=%.4f, bpp=%.4f psnr=%.4f'
-                                % (
-                                    it, temperature, obj, mse_, train_bpp_, psnr_, rd_loss_after_rounding,
-                                    bpp_after_rounding,
-                                    psnr_after_rounding))
-                        else:
-                            print('it=%d, T=%.3f rd_loss=%.4f mse=%.3f bpp=%.4f psnr=%.4f' % (
-                                it, temperature, obj, mse_, train_bpp_, psnr_))
-                    rd_loss_hist.append(obj)
-                print()
-
-                # 2. Fix y_tilde, perform rate optimization w.r.t. z_mean and z_logvar.
-                y_tilde_cur = np.round(y_cur)  # this is the latents we end up transmitting
-                # rate_feed_dict = {y_tilde: y_tilde_cur, **x_feed_dict}
-                rate_feed_dict = {y_tilde: y_tilde_cur}
-                np.random.seed(seed)
-                tf.set_random_seed(seed)
-                print('----Rate Optimization----')
-                # Reinitialize based on the value of y_tilde
-                z_mean_cur, z_logvar_cur = sess.run([z_mean_init, z_logvar_init], feed_dict=rate_feed_dict)  # np arrays
-
-                r_loss_hist = []
-                # rate_grad_hist = []
-
-                adam_optimizer = Adam(lr=r_lr)
-                for it in range(r_opt_its):
-                    grads, obj = sess.run([r_gradients, train_bpp],
-                                          feed_dict={z_mean: z_mean_cur, z_logvar: z_logvar_cur, **rate_feed_dict})
-                    z_mean_cur, z_logvar_cur = adam_optimizer.update([z_mean_cur, z_logvar_cur], grads)
-                    if it % log_itv == 0 or it + 1 == r_opt_its:
-                        print('it=', it, '\trate=', obj)
-                    r_loss_hist.append(obj)
-                    # rate_grad_hist.append(np.mean(np.abs(grads)))
-                print()
-
-                # fig, axes = plt.subplots(nrows=2, sharex=True)
-                # axes[0].plot(rd_loss_hist)
-                # axes[0].set_ylabel('RD loss')
-                # axes[1].plot(r_loss_hist)
-                # axes[1].set_ylabel('Rate loss')
-                # axes[1].set_xlabel('SGD iterations')
-                # plt.savefig('plots/local_q_opt_hist-%s-input=%s-b=%d.png' %
-                #             (args.runname, os.path.basename(args.input_file), batch_idx))
-
-                # If requested, transform the quantized image back and measure performance.
-                eval_arrs = sess.run(eval_tensors, feed_dict={y_tilde: y_tilde_cur, z_mean: z_mean_cur,
-                                                              z_logvar: z_logvar_cur, **x_feed_dict})
-                for field, arr in zip(eval_fields, eval_arrs):
-                    all_results_arrs[field] += arr.tolist()
-
-                batch_idx += 1
-
-            except tf.errors.OutOfRangeError:
-                break
-
-        for field in eval_fields:
-            all_results_arrs[field] = np.asarray(all_results_arrs[field])
-
-        input_file = os.path.basename(args.input_file)
-        results_dict = all_results_arrs
-        trained_script_name = args.runname.split('-')[0]
-        script_name = os.path.splitext(os.path.basename(__file__))[0]  # current script name, without extension
-        save_file = 'rd-%s-input=%s.npz' % (args.runname, input_file)
-        if script_name != trained_script_name:
-            save_file = 'rd-%s-lmbda=%g+%s-input=%s.npz' % (
-                script_name, args.lmbda, args.runname, input_file)
-        np.savez(os.path.join(args.results_dir, save_file), **results_dict)
-
-        for field in eval_fields:
-            arr = all_results_arrs[field]
-            print('Avg {}: {:0.4f}'.format(field, arr.mean()))
+    # the optimization loops run in opt_sess, and everything else in sess (the same session, unless mixed_precision)
+    sess, opt_sess, _ = _build_and_restore(args)
+    sessions = {sess, opt_sess}
+    graph = compression_graph(args, X.shape[1:])
+    for session in sessions:
+        session.run([graph.load_images, graph.init_batches],
+                    feed_dict={graph.images_ph: X, graph.num_images_ph: num_images})
+
+    def copy_latents(from_sess, to_sess):
+        if from_sess is not to_sess:
+            to_sess.run(graph.load_latents, feed_dict=dict(zip(graph.latent_phs, from_sess.run(graph.latents))))
+
+    eval_fields = ['mse', 'psnr', 'msssim', 'msssim_db', 'est_bpp', 'est_y_bpp', 'est_z_bpp', 'est_bpp_back']
+    # filled in across all batches
+    all_results_arrs = {key: np.empty(num_images, dtype='float32') for key in eval_fields}
+    write_idx = 0
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    batch_idx = 0
+    while True:
+        try:
+            for session in sessions:
+                session.run(graph.load_x)
+            # 1. Perform R-D optimization conditioned on ground truth x
+            print('----RD Optimization----')
+            sess.run(graph.rd_init_op)
+            copy_latents(sess, opt_sess)
+            feed_dict = {graph.batch_seed: batch_idx}
+            rd_loss_hist = []
+
+            opt_record = {'its': [], 'T': [], 'rd_loss': [], 'rd_loss_after_rounding': []}
+            _, hists = opt_sess.run([graph.rd_opt_op, graph.rd_hists], feed_dict=feed_dict)
+            for it, (temperature, obj, mse_, train_bpp_, psnr_, *after_rounding) in enumerate(zip(*hists)):
+                if it % graph.log_itv == 0 or it + 1 == graph.rd_opt_its:
+                    if args.verbose:
+                        rd_loss_after_rounding, bpp_after_rounding, psnr_after_rounding = after_rounding
+                        print(
+                            'it=%d, T=%.3f rd_loss=%.4f mse=%.3f bpp=%.4f psnr=%.4f\t after rounding: rd_loss=%.4f, bpp=%.4f psnr=%.4f'
+                            % (
+                                it, temperature, obj, mse_, train_bpp_, psnr_, rd_loss_after_rounding,
+                                bpp_after_rounding,
+                                psnr_after_rounding))
+                    else:
+                        print('it=%d, T=%.3f rd_loss=%.4f mse=%.3f bpp=%.4f psnr=%.4f' % (
+                            it, temperature, obj, mse_, train_bpp_, psnr_))
+                rd_loss_hist.append(obj)
+            print()
+
+            # 2. Fix y_tilde, perform rate optimization w.r.t. z_mean and z_logvar.
+            print('----Rate Optimization----')
+            # Reinitialize based on the value of y_tilde
+            copy_latents(opt_sess, sess)
+            sess.run(graph.r_init_op)
+            copy_latents(sess, opt_sess)
+            _, r_loss_hist = opt_sess.run([graph.r_opt_op, graph.r_hist], feed_dict=feed_dict)
+            copy_latents(opt_sess, sess)
+            for it, obj in enumerate(r_loss_hist):
+                if it % graph.log_itv == 0 or it + 1 == graph.r_opt_its:
+                    print('it=', it, '\trate=', obj)
+            print()
+
+            # fig, axes = plt.subplots(nrows=2, sharex=True)
+            # axes[0].plot(rd_loss_hist)
+            # axes[0].set_ylabel('RD loss')
+            # axes[1].plot(r_loss_hist)
+            # axes[1].set_ylabel('Rate loss')
+            # axes[1].set_xlabel('SGD iterations')
+            # plt.savefig('plots/local_q_opt_hist-%s-input=%s-b=%d.png' %
+            #             (args.runname, os.path.basename(args.input_file), batch_idx))
+
+            # If requested, transform the quantized image back and measure performance.
+            eval_arrs = sess.run(graph.eval_tensors, feed_dict=feed_dict)
+            for field, arr in zip(eval_fields, eval_arrs):
+                all_results_arrs[field][write_idx:write_idx + len(arr)] = arr
+            write_idx += len(eval_arrs[0])
+
+            batch_idx += 1
+
+        except tf.errors.OutOfRangeError:
+            break
+
+    for session in sessions:
+        session.run(graph.release_op)  # the graph and sessions are kept for further inputs, but not this input's data
+
+    input_file = os.path.basename(args.input_file)
+    results_dict = all_results_arrs
+    trained_script_name = args.runname.split('-')[0]
+    script_name = os.path.splitext(os.path.basename(__file__))[0]  # current script name, without extension
+    save_file = 'rd-%s-input=%s.npz' % (args.runname, input_file)
+    if script_name != trained_script_name:
+        save_file = 'rd-%s-lmbda=%g+%s-input=%s.npz' % (
+            script_name, args.lmbda, args.runname, input_file)
+    np.savez(os.path.join(args.results_dir, save_file), **results_dict)
+
+    for field in eval_fields:
+        arr = all_results_arrs[field]
+        print('Avg {}: {:0.4f}'.format(field, arr.mean()))
 
 
 from tf_boilerplate import parse_args
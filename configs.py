@@ -5,6 +5,20 @@ write_tfci_for_eval = True
 eval_batch_num_pixels = 1e7  # num pixels in the batch; corresponding to 10 1000x1000 images, using 0.03GB memory (conversion from number of pixels to bytes: #bytes = #pixels * 24 / 8)
 
 
+# Grappler rewrites applied to the compression-time optimization graphs (arithmetic_optimization also performs common
+# subexpression elimination); set on the ConfigProto of the compression session
+grappler_options = {'arithmetic_optimization': True, 'constant_folding': True, 'layout_optimizer': True,
+                    'remapping': True}
+# Run the R-D and rate optimization loops with Grappler's auto_mixed_precision rewrite, i.e. in float16 where it
+# deems it safe (mostly the convolutions of the transforms), on GPUs with tensor cores. The loops then run in a
+# separate session, so that the initialization and the evaluation of the latents stay in float32; off by default, as
+# it changes the optimized latents and hence the results.
+mixed_precision = False
+# XLA auto-clustering of the compression-time graph, fusing the many small element-wise ops of the optimization loops
+# (Gumbel-softmax rounding, likelihoods) into fewer kernels; ops that XLA can't compile are left out of the clusters
+xla_jit = True
+
+
 def get_eval_batch_size(num_pixels_per_image):
     return round(eval_batch_num_pixels / num_pixels_per_image)
 